@@ -5,117 +5,223 @@ A super simple FastAPI application that allows students to view and sign up
 for extracurricular activities at Mergington High School.
 """
 
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Request, Response
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import RedirectResponse
-from sqlalchemy.orm import Session
+from fastapi.responses import JSONResponse, RedirectResponse
+from sqlalchemy import Integer, bindparam, delete, func, lambda_stmt, select
+from sqlalchemy.dialects.sqlite import insert
+import hashlib
+import orjson
 import os
 from pathlib import Path
-from database import get_db, init_db, Activity, Student, Registration
+from database import ScopedSession, request_scope, init_db, Activity, Student, Registration
+
+
+class ORJSONResponse(JSONResponse):
+    """JSON response encoded with orjson instead of the stdlib json module"""
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content)
+
 
 app = FastAPI(title="Mergington High School API",
-              description="API for viewing and signing up for extracurricular activities")
+              description="API for viewing and signing up for extracurricular activities",
+              default_response_class=ORJSONResponse)
 
 # Mount the static files directory
 current_dir = Path(__file__).parent
 app.mount("/static", StaticFiles(directory=os.path.join(Path(__file__).parent,
           "static")), name="static")
 
+# Give each request its own scoped session and close it once the response is ready
+@app.middleware("http")
+async def db_session_middleware(request: Request, call_next):
+    token = request_scope.set(object())
+    try:
+        return await call_next(request)
+    finally:
+        await ScopedSession.remove()
+        request_scope.reset(token)
+
+
+# Statements used on every signup/unregister, built once so SQLAlchemy can
+# reuse their compiled SQL instead of reconstructing them per request
+_activity_id_by_name = lambda_stmt(
+    lambda: select(Activity.id).where(Activity.name == bindparam("activity_name"))
+)
+_student_id_by_email = lambda_stmt(
+    lambda: select(Student.id).where(Student.email == bindparam("email"))
+)
+_registration_id = lambda_stmt(
+    lambda: select(Registration.id).where(
+        Registration.student_id == bindparam("student_id"),
+        Registration.activity_id == bindparam("activity_id")
+    )
+)
+_insert_student = lambda_stmt(
+    lambda: insert(Student)
+    .values(email=bindparam("email"))
+    .on_conflict_do_nothing(index_elements=["email"])
+)
+# Inserts the registration only while the activity has spots left; the count
+# and the insert run as one statement so concurrent signups can't overfill.
+# Targets the Table so the session runs it as plain Core and keeps rowcount
+_insert_registration = lambda_stmt(
+    lambda: insert(Registration.__table__)
+    .from_select(
+        ["student_id", "activity_id"],
+        select(bindparam("student_id", type_=Integer()), Activity.id).where(
+            Activity.id == bindparam("activity_id"),
+            select(func.count())
+            .where(Registration.activity_id == Activity.id)
+            .scalar_subquery() < Activity.max_participants
+        )
+    )
+    .on_conflict_do_nothing(index_elements=["student_id", "activity_id"])
+)
+_delete_registration = lambda_stmt(
+    lambda: delete(Registration).where(
+        Registration.student_id == select(Student.id)
+        .where(Student.email == bindparam("email"))
+        .scalar_subquery(),
+        Registration.activity_id == select(Activity.id)
+        .where(Activity.name == bindparam("activity_name"))
+        .scalar_subquery()
+    )
+)
+
+
+# Cached /activities body and ETag, tagged with the data version they were built from
+_activities_cache = None
+_activities_version = 0
+
+
+def _invalidate_activities_cache():
+    """Bump the data version so the next read rebuilds the activities payload"""
+    global _activities_version
+    _activities_version += 1
+
+
 # Initialize database on startup
 @app.on_event("startup")
-def startup_event():
-    init_db()
+async def startup_event():
+    await init_db()
+
+
+ROOT_REDIRECT_URL = "/static/index.html"
 
 
 @app.get("/")
-def root():
-    return RedirectResponse(url="/static/index.html")
+async def root():
+    return RedirectResponse(url=ROOT_REDIRECT_URL)
 
 
 @app.get("/activities")
-def get_activities(db: Session = Depends(get_db)):
+async def get_activities(request: Request):
     """Get all activities with participant information"""
-    activities_list = db.query(Activity).all()
+    version = _activities_version
+    if _activities_cache is None or _activities_cache[0] != version:
+        await _build_activities_cache(version)
+    _, body, etag = _activities_cache
     
+    # Let browsers and proxies reuse the body briefly and revalidate by ETag
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=5"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+async def _build_activities_cache(version):
+    """Query all activities and cache the encoded response for this data version"""
+    global _activities_cache
+    db = ScopedSession()
+    rows = (await db.execute(
+        select(
+            Activity.name,
+            Activity.description,
+            Activity.schedule,
+            Activity.max_participants,
+            Student.email
+        )
+        .select_from(Activity)
+        .outerjoin(Registration, Registration.activity_id == Activity.id)
+        .outerjoin(Student, Student.id == Registration.student_id)
+        .order_by(Activity.id, Registration.id)
+    )).all()
+
     # Format response to match existing API structure
     result = {}
-    for activity in activities_list:
-        participants = [reg.student.email for reg in activity.registrations]
-        result[activity.name] = {
-            "description": activity.description,
-            "schedule": activity.schedule,
-            "max_participants": activity.max_participants,
-            "participants": participants
-        }
-    
-    return result
+    for name, description, schedule, max_participants, email in rows:
+        activity = result.setdefault(name, {
+            "description": description,
+            "schedule": schedule,
+            "max_participants": max_participants,
+            "participants": []
+        })
+        if email is not None:
+            activity["participants"].append(email)
+
+    # Hash the content rather than using the version so ETags stay valid
+    # across restarts and between worker processes
+    body = orjson.dumps(result)
+    etag = f'"{hashlib.blake2b(body, digest_size=8).hexdigest()}"'
+    _activities_cache = (version, body, etag)
 
 
 @app.post("/activities/{activity_name}/signup")
-def signup_for_activity(activity_name: str, email: str, db: Session = Depends(get_db)):
+async def signup_for_activity(activity_name: str, email: str):
     """Sign up a student for an activity"""
-    # Get or create student
-    student = db.query(Student).filter(Student.email == email).first()
-    if not student:
-        student = Student(email=email)
-        db.add(student)
-        db.flush()
+    db = ScopedSession()
     
     # Get activity
-    activity = db.query(Activity).filter(Activity.name == activity_name).first()
-    if not activity:
+    activity_id = await db.scalar(_activity_id_by_name, {"activity_name": activity_name})
+    if activity_id is None:
         raise HTTPException(status_code=404, detail="Activity not found")
     
-    # Check if already registered
-    existing_registration = db.query(Registration).filter(
-        Registration.student_id == student.id,
-        Registration.activity_id == activity.id
-    ).first()
+    # Get or create student
+    await db.execute(_insert_student, {"email": email})
+    student_id = await db.scalar(_student_id_by_email, {"email": email})
     
-    if existing_registration:
+    # Create registration if the activity has room
+    params = {"student_id": student_id, "activity_id": activity_id}
+    result = await db.execute(_insert_registration, params)
+    if not result.rowcount:
+        already_registered = await db.scalar(_registration_id, params)
         raise HTTPException(
             status_code=400,
-            detail="Student is already signed up"
+            detail="Student is already signed up" if already_registered else "Activity is full"
         )
     
-    # Create registration
-    registration = Registration(student_id=student.id, activity_id=activity.id)
-    db.add(registration)
-    db.commit()
+    await db.commit()
+    _invalidate_activities_cache()
     
     return {"message": f"Signed up {email} for {activity_name}"}
 
 
 @app.delete("/activities/{activity_name}/unregister")
-def unregister_from_activity(activity_name: str, email: str, db: Session = Depends(get_db)):
+async def unregister_from_activity(activity_name: str, email: str):
     """Unregister a student from an activity"""
-    # Get student
-    student = db.query(Student).filter(Student.email == email).first()
-    if not student:
-        raise HTTPException(
-            status_code=400,
-            detail="Student not found"
-        )
-    
-    # Get activity
-    activity = db.query(Activity).filter(Activity.name == activity_name).first()
-    if not activity:
-        raise HTTPException(status_code=404, detail="Activity not found")
+    db = ScopedSession()
     
-    # Find registration
-    registration = db.query(Registration).filter(
-        Registration.student_id == student.id,
-        Registration.activity_id == activity.id
-    ).first()
+    # Delete registration in one statement, resolving ids with subqueries
+    params = {"activity_name": activity_name, "email": email}
+    result = await db.execute(_delete_registration, params)
     
-    if not registration:
+    if not result.rowcount:
+        # Work out why nothing was deleted only on the error path
+        if await db.scalar(_student_id_by_email, params) is None:
+            raise HTTPException(
+                status_code=400,
+                detail="Student not found"
+            )
+        if await db.scalar(_activity_id_by_name, params) is None:
+            raise HTTPException(status_code=404, detail="Activity not found")
         raise HTTPException(
             status_code=400,
             detail="Student is not signed up for this activity"
         )
     
-    # Delete registration
-    db.delete(registration)
-    db.commit()
+    await db.commit()
+    _invalidate_activities_cache()
     
     return {"message": f"Unregistered {email} from {activity_name}"}
@@ -2,18 +2,54 @@
 Database models and session management for Mergington High School Management System
 """
 
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, ForeignKey, Table
+from sqlalchemy import event, make_url, insert, select, text, Column, Integer, String, DateTime, ForeignKey, Index, Table
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, async_scoped_session
+from sqlalchemy.orm import relationship
+from contextvars import ContextVar
 from datetime import datetime
 import os
 
-# Create database engine
+# Create database engine; signup relies on SQLite's INSERT ... ON CONFLICT,
+# so only SQLite URLs are supported and they always use the aiosqlite driver
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./mergington_high.db")
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False} if DATABASE_URL.startswith("sqlite") else {})
+database_url = make_url(DATABASE_URL)
+if database_url.get_backend_name() != "sqlite":
+    raise ValueError(f"Only SQLite databases are supported, got {DATABASE_URL!r}")
+# In-memory databases get a single-connection pool that takes no sizing options
+pool_args = {} if database_url.database in (None, "", ":memory:") else {
+    "pool_size": 20,
+    "max_overflow": 10,
+    "pool_timeout": 30,
+    "pool_pre_ping": True,
+    "pool_recycle": 3600,
+}
+engine = create_async_engine(
+    database_url.set(drivername="sqlite+aiosqlite"),
+    connect_args={"check_same_thread": False},
+    **pool_args
+)
+
+
+# Tune SQLite connections for concurrent reads and cheaper commits
+@event.listens_for(engine.sync_engine, "connect")
+def _set_sqlite_pragma(dbapi_conn, _):
+    """Use WAL and relaxed fsync so readers don't block behind writers"""
+    cursor = dbapi_conn.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA cache_size=-64000")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.close()
+
 
 # Create session factory
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+AsyncSessionLocal = async_sessionmaker(engine, autoflush=False, expire_on_commit=False)
+
+# One session per request, keyed by a token the request middleware sets
+request_scope = ContextVar("request_scope", default=None)
+ScopedSession = async_scoped_session(AsyncSessionLocal, scopefunc=request_scope.get)
 
 # Create base class for models
 Base = declarative_base()
@@ -24,7 +60,7 @@ class Activity(Base):
     """Activity/Event model"""
     __tablename__ = "activities"
 
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True)
     name = Column(String, unique=True, nullable=False, index=True)
     description = Column(String, nullable=False)
     schedule = Column(String, nullable=False)
@@ -40,7 +76,7 @@ class Student(Base):
     """Student model"""
     __tablename__ = "students"
 
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True)
     email = Column(String, unique=True, nullable=False, index=True)
     name = Column(String, nullable=True)
     grade_level = Column(String, nullable=True)
@@ -53,10 +89,13 @@ class Student(Base):
 class Registration(Base):
     """Registration model (many-to-many relationship between students and activities)"""
     __tablename__ = "registrations"
+    __table_args__ = (
+        Index("uq_student_activity", "student_id", "activity_id", unique=True),
+    )
 
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True)
     student_id = Column(Integer, ForeignKey("students.id"), nullable=False)
-    activity_id = Column(Integer, ForeignKey("activities.id"), nullable=False)
+    activity_id = Column(Integer, ForeignKey("activities.id"), nullable=False, index=True)
     registered_at = Column(DateTime, default=datetime.utcnow)
 
     # Relationships
@@ -64,25 +103,42 @@ class Registration(Base):
     activity = relationship("Activity", back_populates="registrations")
 
 
-def get_db():
-    """Dependency to get database session"""
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+# Indexes older databases created on INTEGER PRIMARY KEY columns, which
+# SQLite already looks up through the rowid
+REDUNDANT_INDEXES = (
+    "ix_activities_id",
+    "ix_students_id",
+    "ix_registrations_id",
+)
+
+
+def _create_missing_indexes(conn):
+    """Add indexes declared after a table was first created"""
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
 
 
-def init_db():
+async def init_db():
     """Initialize database with tables and seed data"""
     # Create all tables
-    Base.metadata.create_all(bind=engine)
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+        # Older databases could hold duplicate signups, which would stop the
+        # unique index that signup's ON CONFLICT relies on from being created
+        await conn.execute(text(
+            "DELETE FROM registrations WHERE id NOT IN "
+            "(SELECT MIN(id) FROM registrations GROUP BY student_id, activity_id)"
+        ))
+        await conn.run_sync(_create_missing_indexes)
+        for index_name in REDUNDANT_INDEXES:
+            await conn.execute(text(f"DROP INDEX IF EXISTS {index_name}"))
     
     # Seed initial data
-    db = SessionLocal()
+    db = AsyncSessionLocal()
     try:
         # Check if we already have data
-        if db.query(Activity).count() > 0:
+        if await db.scalar(select(1).select_from(Activity).limit(1)) is not None:
             print("Database already initialized")
             return
         
@@ -166,21 +222,13 @@ def init_db():
             {"email": "henry@mergington.edu", "name": "Henry"}
         ]
         
-        # Create activities
-        activity_map = {}
-        for activity_data in initial_activities:
-            activity = Activity(**activity_data)
-            db.add(activity)
-            db.flush()
-            activity_map[activity_data["name"]] = activity
+        # Create activities and students in one multi-row INSERT per table
+        await db.execute(insert(Activity), initial_activities)
+        await db.execute(insert(Student), initial_students)
         
-        # Create students
-        student_map = {}
-        for student_data in initial_students:
-            student = Student(**student_data)
-            db.add(student)
-            db.flush()
-            student_map[student_data["email"]] = student
+        # Look up generated ids without loading full objects
+        activity_map = dict((await db.execute(select(Activity.name, Activity.id))).all())
+        student_map = dict((await db.execute(select(Student.email, Student.id))).all())
         
         # Create initial registrations
         initial_registrations = [
@@ -195,18 +243,17 @@ def init_db():
             ("Debate Team", ["charlotte@mergington.edu", "henry@mergington.edu"])
         ]
         
-        for activity_name, student_emails in initial_registrations:
-            activity = activity_map[activity_name]
-            for email in student_emails:
-                student = student_map[email]
-                registration = Registration(student_id=student.id, activity_id=activity.id)
-                db.add(registration)
+        await db.execute(insert(Registration), [
+            {"student_id": student_map[email], "activity_id": activity_map[activity_name]}
+            for activity_name, student_emails in initial_registrations
+            for email in student_emails
+        ])
         
-        db.commit()
+        await db.commit()
         print("Database initialized successfully with seed data")
     except Exception as e:
         print(f"Error initializing database: {e}")
-        db.rollback()
+        await db.rollback()
         raise
     finally:
-        db.close()
+        await db.close()
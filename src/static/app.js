@@ -7,7 +7,8 @@ document.addEventListener("DOMContentLoaded", () => {
   // Function to fetch activities from API
   async function fetchActivities() {
     try {
-      const response = await fetch("/activities");
+      // Revalidate so a fresh signup or unregister shows up immediately
+      const response = await fetch("/activities", { cache: "no-cache" });
       const activities = await response.json();
 
       // Clear loading message